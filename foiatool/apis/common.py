@@ -1,11 +1,22 @@
 import foiatool.config as fconfig
+import foiatool.data as fdb
 
 import requests
+import urllib3
 import pathlib
 import tqdm
 import os
-import re
 import urllib
+import email.utils
+import datetime
+import json
+import time
+import threading
+import sqlite3
+import uuid
+import concurrent.futures
+
+_SANITIZE_TABLE = str.maketrans({":": "_", "/": "_"})
 
 
 def get_download_dir(config: fconfig.RequestConfig) -> pathlib.Path:
@@ -14,8 +25,61 @@ def get_download_dir(config: fconfig.RequestConfig) -> pathlib.Path:
     return download_dir
 
 
+def get_cookie_path(config: fconfig.RequestConfig) -> str:
+    # Cookies are credentials, so keep them out of the (shareable) project dir
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    url_parts = urllib.parse.urlparse(config.url)
+    file_name = f"{url_parts.netloc}_{config.user}.json".translate(_SANITIZE_TABLE)
+    return os.path.join(cache_dir, "foiatool", file_name)
+
+
+def get_http_cache_path(config: fconfig.RequestConfig) -> str:
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    url_parts = urllib.parse.urlparse(config.url)
+    file_name = f"{url_parts.netloc}_http.db".translate(_SANITIZE_TABLE)
+    return os.path.join(cache_dir, "foiatool", file_name)
+
+
+def load_cookies(jar: requests.cookies.RequestsCookieJar, path: str):
+    try:
+        with open(path, "r") as f:
+            cookies = json.load(f)
+    except (OSError, ValueError):
+        return
+
+    now = time.time()
+    for cookie in cookies:
+        if cookie.get("expires") and cookie["expires"] < now:
+            continue
+        jar.set_cookie(requests.cookies.create_cookie(**cookie))
+
+
+def save_cookies(jar: requests.cookies.RequestsCookieJar, path: str):
+    cookies = [
+        dict(
+            name=c.name,
+            value=c.value,
+            domain=c.domain,
+            path=c.path,
+            expires=c.expires,
+            secure=c.secure,
+        )
+        for c in jar
+    ]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(fd, "w") as f:
+        json.dump(cookies, f)
+
+
 def truncate_file_name(file_name: str):
-    fname, ext = os.path.splitext(file_name)
+    if len(file_name) <= 255:
+        return file_name
+    fname, dot, ext = file_name.rpartition(".")
+    # Like os.path.splitext, leading dots don't start an extension
+    if not fname.strip("."):
+        return file_name[:255]
+    ext = dot + ext
     tlen = 255 - len(ext)
     return fname[:tlen] + ext
 
@@ -23,38 +87,230 @@ def truncate_file_name(file_name: str):
 def normalize_file_name(download_dir: str, request_id: str, file_name: str):
     # Some documents don't have requests associated with them
     folder_name = f"{request_id}" if request_id else "orphans"
-    out_dir = pathlib.Path(download_dir) / folder_name
-    out_dir.mkdir(parents=True, exist_ok=True)
+    out_dir = os.path.join(download_dir, folder_name)
+    # Always check, the folder may have been removed since the last download
+    os.makedirs(out_dir, exist_ok=True)
     file_name = truncate_file_name(file_name)
-    file_name = re.sub("[:/]", "_", file_name)
-    return str(out_dir / file_name)
+    file_name = file_name.translate(_SANITIZE_TABLE)
+    return os.path.join(out_dir, file_name)
+
+
+def parse_retry_after(value: str):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = datetime.datetime.now(when.tzinfo)
+    return max(0.0, (when - now).total_seconds())
+
+
+class RateLimiter:
+    # Token bucket shared by every thread talking to one portal. Unlike a
+    # sleep after each call, time spent doing the work counts towards the wait
+    def __init__(self, rate: float, burst: int = 1):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self._burst, self._tokens + (now - self._updated) * self._rate
+                )
+                self._updated = now
+                wait = self._paused_until - now
+                if wait <= 0 and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                self._cond.wait(max(wait, (1 - self._tokens) / self._rate))
+
+    def pause(self, seconds: float):
+        # The server told us to back off, hold every caller until then
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class HTTPCache:
+    # Remembers the validators and body of responses so repeat visits can be
+    # answered with a 304 instead of the whole document. Entries older than
+    # MAX_AGE_SECONDS are dropped when the cache is opened
+    MAX_AGE_SECONDS = 30 * 24 * 60 * 60
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=wal")
+            columns = [
+                row[1]
+                for row in self._conn.execute("PRAGMA table_info(http_cache)")
+            ]
+            if columns and "stored_at" not in columns:
+                # Made by an older version, it's only a cache so start over
+                self._conn.execute("DROP TABLE http_cache")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS http_cache (url TEXT PRIMARY KEY, "
+                "etag TEXT, last_modified TEXT, body BLOB, stored_at REAL)"
+            )
+            self._conn.execute(
+                "DELETE FROM http_cache WHERE stored_at < ?",
+                (time.time() - HTTPCache.MAX_AGE_SECONDS,),
+            )
+
+    def get(self, url: str):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT etag, last_modified, body FROM http_cache WHERE url = ?",
+                (url,),
+            ).fetchone()
+
+    def put(self, url: str, etag: str, last_modified: str, body: bytes):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO http_cache VALUES (?, ?, ?, ?, ?)",
+                (url, etag, last_modified, body, time.time()),
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_DEFAULT_SESSION = None
+
+
+def _default_session() -> requests.Session:
+    global _DEFAULT_SESSION
+    if _DEFAULT_SESSION is None:
+        _DEFAULT_SESSION = requests.Session()
+    return _DEFAULT_SESSION
+
+
+def time_left(deadline: float = None):
+    # Seconds until a time.monotonic() deadline, or None when there isn't one.
+    # Raises once it has passed
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DownloadException("Download took too long")
+    return remaining
+
+
+def _read_raw(resp: requests.Response, size: int) -> bytes:
+    # requests only wraps urllib3's errors when it does the reading itself
+    try:
+        return resp.raw.read(size)
+    except urllib3.exceptions.HTTPError as e:
+        raise requests.ConnectionError(e, response=resp) from e
 
 
 def download_file(
-    session: requests.Session,
     url: str,
-    outpath: str = None,
+    outpath: str,
+    *,
+    session: requests.Session = None,
     display_progress: bool = False,
-):
-    resp = session.get(url, stream=True, allow_redirects=True)
-    resp.raise_for_status()
+    block_size: int = 1 << 20,
+    deadline: float = None,
+) -> str:
+    # Returns the checksum of the downloaded file. It's computed while the
+    # bytes go by so the file never has to be read back.
+    # A deadline (from time.monotonic) also bounds every socket read, so a
+    # stalled connection can't hold the thread forever
+    session = session or _default_session()
+    digest = fdb.new_checksum()
+    # Closing the response hands the connection back to the pool even when
+    # writing the file fails part way
+    with session.get(
+        url, stream=True, allow_redirects=True, timeout=time_left(deadline)
+    ) as resp:
+        resp.raise_for_status()
 
-    total_size = int(resp.headers.get("content-length", 0))
-    block_size = 1024
+        total_size = int(resp.headers.get("content-length", 0))
+
+        # Documents are usually zips or pdfs served without a transfer
+        # encoding, in which case the bytes go from the socket to disk untouched
+        resp.raw.decode_content = "content-encoding" in resp.headers
 
-    try:
         pbar = None
         if display_progress:
-            pbar = tqdm.tqdm(total=total_size, unit="B", unit_scale=True)
+            pbar = tqdm.tqdm(
+                total=total_size,
+                unit="B",
+                unit_scale=True,
+                mininterval=0.2,
+                maxinterval=1.0,
+            )
+        # Write next to the destination and move it into place once complete,
+        # so an interrupted download never leaves a truncated file behind.
+        # A short temp name so a full length file name can't overflow
+        part_path = os.path.join(
+            os.path.dirname(outpath), f".{uuid.uuid4().hex}.part"
+        )
+        try:
+            with open(part_path, "xb") as f:
+                while chunk := _read_raw(resp, block_size):
+                    f.write(chunk)
+                    digest.update(chunk)
+                    time_left(deadline)
+                    if pbar:
+                        pbar.update(len(chunk))
+            os.replace(part_path, outpath)
+        except BaseException:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        finally:
+            if pbar:
+                pbar.close()
+
+    return digest.hexdigest()
+
+
+def _discard_download(future: concurrent.futures.Future):
+    if not future.cancelled() and future.exception() is None:
+        path, _ = future.result()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def wait_for_download(future: concurrent.futures.Future, timeout: float = None):
+    # Waits for a download that resolves to (path, checksum). The timeout
+    # covers the download itself, and separately how long it may sit queued
+    # behind others on the pool. One that overruns is cancelled, or if it's
+    # already under way its file is removed when it finishes, since nothing
+    # will record it
+    if timeout is not None:
+        queued_until = time.monotonic() + timeout
+        while not (future.running() or future.done()):
+            if time.monotonic() > queued_until:
+                abandon_download(future)
+                raise concurrent.futures.TimeoutError()
+            time.sleep(0.1)
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        abandon_download(future)
+        raise
+
 
-        with open(outpath, "wb") as f:
-            for chunk in resp.iter_content(chunk_size=block_size):
-                read_amt = f.write(chunk)
-                if pbar:
-                    pbar.update(read_amt)
-    finally:
-        if pbar:
-            pbar.close()
+def abandon_download(future: concurrent.futures.Future):
+    if not future.cancel():
+        future.add_done_callback(_discard_download)
 
 
 class DownloadException(Exception):
@@ -64,3 +320,4 @@ class DownloadException(Exception):
 
 HTTPException = requests.HTTPError
 ConnectionException = requests.ConnectionError
+RequestException = requests.RequestException
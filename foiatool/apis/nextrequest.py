@@ -2,9 +2,33 @@ import foiatool.apis.common as common
 import foiatool.config as fconfig
 
 import requests
+import requests.adapters
+import urllib3.util
 import concurrent.futures
 import time
-import lxml.html
+import math
+import threading
+import re
+import urllib.parse
+from typing import List, Tuple, Union
+
+try:
+    import orjson
+
+    _loads = orjson.loads
+except ImportError:
+    import json
+
+    _loads = json.loads
+
+
+# Only the csrf meta tag is needed from the page, so avoid building a DOM
+_CSRF_META_RE = re.compile(rb"<meta\s[^>]*name=[\"']csrf-token[\"'][^>]*>", re.I)
+_META_CONTENT_RE = re.compile(rb"\scontent=[\"']([^\"']*)[\"']", re.I)
+
+
+def _deadline(timeout: float = None):
+    return None if timeout is None else time.monotonic() + timeout
 
 
 # TODO: Generalize this interface so we can support other platforms like GovQA
@@ -13,46 +37,172 @@ class NextRequestAPI:
     IS_CLOSED = 1 << 1
     REQUESTS_ENDPOINT = "requests"
     DOCUMENTS_ENDPOINT = "documents"
+    POLL_MIN_SECONDS = 0.25
+    POLL_MAX_SECONDS = 2
+    SEARCH_WORKERS = 8
+    CSRF_TTL_SECONDS = 600
+    # Rails answers a bad authenticity token with 422, other stacks use these
+    CSRF_REJECTED = (401, 403, 419, 422)
 
     def __init__(
-        self, url: str, download_dir: str, username: str, password: str
+        self,
+        url: str,
+        download_dir: str,
+        username: str,
+        password: str,
+        cookie_path: str = None,
+        max_workers: int = 4,
+        min_interval: float = 0,
+        http_cache_path: str = None,
     ) -> None:
         self._url = url.strip()
         self._username = username
         self._password = password
         self._download_dir = download_dir
+        self._cookie_path = cookie_path
         self._authenticated = False
+        self._csrf_token = None
+        self._csrf_fetched_at = 0
+        self._csrf_lock = threading.Lock()
+        # Paces searches and task visits across all threads
+        self._limiter = None
+        if min_interval > 0:
+            self._limiter = common.RateLimiter(1 / min_interval)
 
         self._session = requests.Session()
         self._session.headers["user-agent"] = (
             "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36"
         )
-
-    def _get_csrf(self, page_txt: str):
-        # TODO: Maybe there's a better way to do this...
-        page = lxml.html.fromstring(page_txt)
-        if meta_element := page.xpath("//meta[@name='csrf-token']"):
-            return meta_element[0].get("content")
+        # Keep connections alive and share them between the search, metadata
+        # and download calls. This also covers the storage host the bulk zips
+        # get redirected to.
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=max_workers,
+            pool_maxsize=max(
+                max_workers * 2, max_workers + NextRequestAPI.SEARCH_WORKERS
+            ),
+            # Back off when the portal says we're going too fast or is briefly
+            # unavailable. The last error response is returned rather than
+            # raised so raise_for_status sees it. Only reads are retried, a
+            # resent PUT /client/documents/bulk would start a second zip job
+            max_retries=urllib3.util.Retry(
+                total=3,
+                backoff_factor=0.3,
+                status_forcelist=[429, 502, 503, 504],
+                allowed_methods=frozenset({"GET", "HEAD"}),
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            ),
+        )
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        if cookie_path:
+            common.load_cookies(self._session.cookies, cookie_path)
+        self._http_cache = None
+        if http_cache_path:
+            self._http_cache = common.HTTPCache(http_cache_path)
+
+        # Downloads run here so callers can keep several of them in flight
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    def _get_csrf(self, page_txt: Union[bytes, str]):
+        if isinstance(page_txt, str):
+            page_txt = page_txt.encode()
+        if meta := _CSRF_META_RE.search(page_txt):
+            if content := _META_CONTENT_RE.search(meta.group(0)):
+                return content.group(1).decode()
         return None
 
     def _get_session(self, csrf_url: str = None) -> requests.Session:
+        # The token is tied to the session rather than the page, so one
+        # fetched for any page stays good until it expires or we sign in
         if csrf_url:
-            page = self._session.get(csrf_url)
-            page.raise_for_status()
+            with self._csrf_lock:
+                age = time.monotonic() - self._csrf_fetched_at
+                if not self._csrf_token or age > NextRequestAPI.CSRF_TTL_SECONDS:
+                    page = self._session.get(csrf_url)
+                    page.raise_for_status()
 
-            csrf = self._get_csrf(page.content)
-            self._session.headers.update({"x-csrf-token": csrf})
+                    self._csrf_token = self._get_csrf(page.content)
+                    self._csrf_fetched_at = time.monotonic()
+                    self._session.headers.update({"x-csrf-token": self._csrf_token})
 
         return self._session
 
+    def _throttled_get(self, url: str, **kwargs) -> requests.Response:
+        if self._limiter:
+            self._limiter.acquire()
+        resp = self._session.get(url, **kwargs)
+        if self._limiter and resp.status_code == 429:
+            # Still limited after the adapter's retries
+            retry_after = common.parse_retry_after(resp.headers.get("Retry-After"))
+            self._limiter.pause(retry_after or NextRequestAPI.POLL_MAX_SECONDS)
+        return resp
+
+    def _cached_get(self, url: str, params: dict = None, throttle: bool = False):
+        # Returns the response body, revalidating a cached copy when we have one
+        get = self._throttled_get if throttle else self._session.get
+        if not self._http_cache:
+            return get(url, params=params).content
+
+        key = requests.Request("GET", url, params=params).prepare().url
+        headers = {}
+        if cached := self._http_cache.get(key):
+            etag, last_modified, body = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        resp = get(url, params=params, headers=headers)
+        if cached and resp.status_code == 304:
+            return body
+
+        etag = resp.headers.get("ETag")
+        last_modified = resp.headers.get("Last-Modified")
+        if resp.ok and (etag or last_modified):
+            self._http_cache.put(key, etag, last_modified, resp.content)
+        return resp.content
+
+    def _invalidate_csrf(self):
+        with self._csrf_lock:
+            self._csrf_token = None
+
+    def _is_signed_in_redirect(self, resp: requests.Response) -> bool:
+        # Only a redirect elsewhere on the portal itself counts. A scheme or
+        # host change, or being sent back to sign in, says nothing about
+        # our cookies
+        location = urllib.parse.urljoin(resp.url, resp.headers.get("Location", ""))
+        target = urllib.parse.urlparse(location)
+        portal = urllib.parse.urlparse(self._url)
+        return (
+            target.scheme == portal.scheme
+            and target.netloc.lower() == portal.netloc.lower()
+            and not target.path.rstrip("/").endswith("/users/sign_in")
+        )
+
     def sign_in(self):
         if self._authenticated:
             return
 
         url = f"{self._url}/users/sign_in"
-        sess = self._get_session(url)
+        sess = self._session
+
+        # Signed in users get redirected away from the sign in page,
+        # which tells us the cookies from the last run are still good
+        page = sess.get(url, allow_redirects=False)
+        page.raise_for_status()
+        if page.is_redirect and self._is_signed_in_redirect(page):
+            self._authenticated = True
+            return
+        if page.is_redirect:
+            # Some other redirect, like http -> https. Go get the actual form
+            page = sess.get(url)
+            page.raise_for_status()
+            url = page.url
 
-        csrf = sess.headers.get("x-csrf-token")
+        csrf = self._get_csrf(page.content)
+        sess.headers.update({"x-csrf-token": csrf})
         payload = {
             "authenticity_token": csrf,
             "user[email]": self._username,
@@ -61,23 +211,25 @@ class NextRequestAPI:
         resp = sess.post(url, params=payload)
         resp.raise_for_status()
 
+        # Signing in rotates the token
+        self._invalidate_csrf()
         self._authenticated = True
+        if self._cookie_path:
+            common.save_cookies(sess.cookies, self._cookie_path)
 
-    def _download_document(self, request_id, doc_id, fname):
+    def _download_document(self, request_id, doc_id, fname, timeout=None):
         # TODO: If there were some API to get document info from doc_id
         # I'd only need doc_id and not request_id or fname
+        deadline = _deadline(timeout)
         session = self._get_session()
         outpath = common.normalize_file_name(self._download_dir, request_id, fname)
         url = f"{self._url}/documents/{doc_id}/download"
-        common.download_file(session, url, outpath)
-        return outpath
+        checksum = common.download_file(
+            url, outpath, session=session, deadline=deadline
+        )
+        return outpath, checksum
 
     def _initiate_bulk_download(self, sess: requests.Session, request_id: str):
-        doc_ids = [
-            dd["id"]
-            for dd in self.get_docs_info_for_request(request_id).get("documents", [])
-        ]
-
         post_data = dict(
             request_id=request_id,
             bulk_action="download",
@@ -85,10 +237,16 @@ class NextRequestAPI:
             visibility="all",
         )
 
-        resp = sess.put(f"{self._url}/client/documents/bulk", json=post_data)
+        url = f"{self._url}/client/documents/bulk"
+        resp = sess.put(url, json=post_data)
+        if resp.status_code in NextRequestAPI.CSRF_REJECTED:
+            # Our cached token went stale, grab a new one and try once more
+            self._invalidate_csrf()
+            sess = self._get_session(f"{self._url}/requests/{request_id}")
+            resp = sess.put(url, json=post_data)
         resp.raise_for_status()
 
-        job_id = resp.json().get("jobId", [None])[0]
+        job_id = _loads(resp.content).get("jobId", [None])[0]
         if not job_id:
             raise common.DownloadException(
                 f"Unable to initiate download: {resp.status_code}"
@@ -97,43 +255,70 @@ class NextRequestAPI:
         return job_id
 
     def _poll_background_job(
-        self, sess: requests.Session, request_id: str, job_id: str, job_type: str
+        self,
+        sess: requests.Session,
+        request_id: str,
+        job_id: str,
+        job_type: str,
+        deadline: float = None,
     ):
         resp = sess.get(
-            f"{self._url}/background_job_logs", params=dict(pretty_id=request_id)
+            f"{self._url}/background_job_logs",
+            params=dict(pretty_id=request_id),
+            timeout=common.time_left(deadline),
         )
         resp.raise_for_status()
 
-        for job in resp.json().get("jobs", []):
-            if job.get("id") == job_id and job.get("status", "") == "working":
-                return True
-        return False
-
-    def _perform_bulk_download(self, request_id: str):
+        retry_after = common.parse_retry_after(resp.headers.get("Retry-After"))
+        for job in _loads(resp.content).get("jobs", []):
+            if job.get("id") == job_id:
+                # Anything other than "working" is a terminal state
+                return job.get("status", "") == "working", retry_after
+        return False, retry_after
+
+    def _perform_bulk_download(self, request_id: str, timeout: float = None):
+        # The timeout covers the whole job, so a zip that never finishes
+        # building can't hold a download worker forever
+        deadline = _deadline(timeout)
         session = self._get_session(f"{self._url}/requests/{request_id}")
 
         job_id = self._initiate_bulk_download(session, request_id)
-        while self._poll_background_job(session, request_id, job_id, "zipfile_creator"):
-            time.sleep(2)  # Timing seen in browser
+
+        # Small zips are usually ready almost immediately, so start polling
+        # quickly and back off towards the 2s interval seen in the browser
+        delay = NextRequestAPI.POLL_MIN_SECONDS
+        while True:
+            running, retry_after = self._poll_background_job(
+                session, request_id, job_id, "zipfile_creator", deadline
+            )
+            if not running:
+                break
+            wait = retry_after or delay
+            if deadline is not None:
+                # Raises once the job has run out of time
+                wait = min(wait, common.time_left(deadline))
+            time.sleep(wait)
+            delay = min(delay * 1.5, NextRequestAPI.POLL_MAX_SECONDS)
 
         params = dict(jid=job_id, request_id=request_id)
         resp = session.get(f"{self._url}/client/documents/download", params=params)
         resp.raise_for_status()
 
-        data = resp.json()
+        data = _loads(resp.content)
         if not (url := data.get("url", "")) or not (fname := data.get("filename", "")):
             raise common.DownloadException(
                 f"Error zipping document: {data.get('message', '')}"
             )
 
         outpath = common.normalize_file_name(self._download_dir, request_id, fname)
-        common.download_file(session, url, outpath, display_progress=False)
+        checksum = common.download_file(
+            url, outpath, session=session, deadline=deadline
+        )
 
-        return outpath
+        return outpath, checksum
 
     def _perform_search(
         self,
-        session: requests.Session,
         term: str,
         page: int,
         endpoint: str,
@@ -145,24 +330,29 @@ class NextRequestAPI:
         if open_mask & NextRequestAPI.IS_CLOSED == NextRequestAPI.IS_CLOSED:
             params["closed"] = True
 
-        return session.get(f"{self._url}/client/{endpoint}", params=params).json()
+        resp = self._throttled_get(f"{self._url}/client/{endpoint}", params=params)
+        return _loads(resp.content)
 
     def _search(self, term: str, endpoint: str, open_mask: int = 0):
-        page = 0
-        consumed = 0
-
-        session = self._get_session()
-
-        resp = self._perform_search(session, term, page, endpoint, open_mask)
+        resp = self._perform_search(term, 0, endpoint, open_mask)
         total_count = resp.get("total_count", 0)
-
-        while consumed < total_count:
-            reqs = resp.get(endpoint, [])
-            consumed += len(reqs)
-            yield reqs
-
-            page += 1
-            resp = self._perform_search(session, term, page, endpoint, open_mask)
+        reqs = resp.get(endpoint, [])
+        if total_count <= 0 or not reqs:
+            return
+        yield reqs
+
+        # The first page tells us the page size, so the remaining pages
+        # can all be requested at once
+        page_count = math.ceil(total_count / len(reqs))
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=NextRequestAPI.SEARCH_WORKERS
+        ) as pool:
+            pages = [
+                pool.submit(self._perform_search, term, page, endpoint, open_mask)
+                for page in range(1, page_count)
+            ]
+            for page in concurrent.futures.as_completed(pages):
+                yield page.result().get(endpoint, [])
 
     def search_requests(self, term: str, open_mask: int = 0):
         return self._search(term, NextRequestAPI.REQUESTS_ENDPOINT, open_mask)
@@ -171,9 +361,11 @@ class NextRequestAPI:
         return self._search(term, NextRequestAPI.DOCUMENTS_ENDPOINT, 0)
 
     def get_request_info(self, req_id: str):
-        return requests.get(
-            f"{self._url}/client/{NextRequestAPI.REQUESTS_ENDPOINT}/{req_id}"
-        ).json()
+        body = self._cached_get(
+            f"{self._url}/client/{NextRequestAPI.REQUESTS_ENDPOINT}/{req_id}",
+            throttle=True,
+        )
+        return _loads(body)
 
     # TODO: Can't find an API endpoint for this...
     # def get_document_info (self, doc_id: str):
@@ -181,21 +373,60 @@ class NextRequestAPI:
 
     def get_docs_info_for_request(self, req_id: str):
         params = dict(request_id=req_id)
-        return requests.get(
-            f"{self._url}/client/request_documents", params=params
-        ).json()
+        body = self._cached_get(f"{self._url}/client/request_documents", params)
+        return _loads(body)
 
-    def download_docs_for_request(self, request_id: str) -> concurrent.futures.Future:
-        with concurrent.futures.ThreadPoolExecutor() as pool:
-            promise = pool.submit(self._perform_bulk_download, request_id)
-        return promise
+    def download_docs_for_request(
+        self, request_id: str, timeout: float = None
+    ) -> concurrent.futures.Future:
+        # The timeout starts once a worker picks the download up
+        return self._pool.submit(self._perform_bulk_download, request_id, timeout)
 
     def download_document(
-        self, request_id: str, doc_id: str, doc_name: str
+        self, request_id: str, doc_id: str, doc_name: str, timeout: float = None
     ) -> concurrent.futures.Future:
-        with concurrent.futures.ThreadPoolExecutor() as pool:
-            promise = pool.submit(self._download_document, request_id, doc_id, doc_name)
-        return promise
+        return self._pool.submit(
+            self._download_document, request_id, doc_id, doc_name, timeout
+        )
+
+    def download_all_documents_parallel(
+        self, request_id: str, timeout: float = None, doc_info: dict = None
+    ) -> List[Tuple[str, str, str]]:
+        # Alternative to the bulk zip: fetch every document on its own,
+        # spread over the download pool. Returns (doc_id, path, checksum).
+        # Pass doc_info if get_docs_info_for_request was already called
+        doc_info = doc_info or self.get_docs_info_for_request(request_id)
+        docs = doc_info.get("documents", [])
+        total = doc_info.get("total_documents_count", len(docs))
+        if len(docs) < total:
+            # Only part of the list came back, downloading it would
+            # look like the whole request
+            raise common.DownloadException(
+                f"Only {len(docs)} of {total} documents listed for {request_id}"
+            )
+
+        doc_ids = [str(doc["id"]) for doc in docs]
+        futures = [
+            self.download_document(
+                request_id, doc_id, f"{doc_id}_{doc.get('title', '')}", timeout
+            )
+            for doc_id, doc in zip(doc_ids, docs)
+        ]
+        results = []
+        try:
+            for doc_id, future in zip(doc_ids, futures):
+                results.append((doc_id, *common.wait_for_download(future, timeout)))
+        except BaseException:
+            # The task failed, so nothing will record the other documents
+            for future in futures:
+                common.abandon_download(future)
+            raise
+        return results
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        if self._http_cache:
+            self._http_cache.close()
 
     def download_dir(self):
         return self._download_dir
@@ -207,4 +438,16 @@ class NextRequestAPI:
 def initialize_nextrequest_client(config: fconfig.RequestConfig) -> NextRequestAPI:
     download_dir = common.get_download_dir(config)
     download_dir.mkdir(parents=True, exist_ok=True)
-    return NextRequestAPI(config.url, str(download_dir), config.user, config.password)
+    http_cache_path = None
+    if config.http_cache:
+        http_cache_path = common.get_http_cache_path(config)
+    return NextRequestAPI(
+        config.url,
+        str(download_dir),
+        config.user,
+        config.password,
+        cookie_path=common.get_cookie_path(config),
+        max_workers=config.max_workers or 4,
+        min_interval=config.download_nice_seconds,
+        http_cache_path=http_cache_path,
+    )
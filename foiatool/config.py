@@ -6,6 +6,13 @@ import toml
 import os
 from typing import List
 import shutil
+import functools
+import copy
+
+try:
+    import tomllib
+except ImportError:
+    import tomli as tomllib
 
 __FOIATOOLS_CONFIG__ = "foiatool.toml"
 __FOIATOOLS_DB__ = "foia.db"
@@ -20,10 +27,17 @@ class RequestConfig:
     password: str
     search_terms: List[str]
     document_search_terms: List[str]
+    # load_config turns this into a frozenset for fast membership checks
     ignore_ids: List[str]
     download_nice_seconds: int
     download_timeout_seconds: int
     download_path: str
+    # Keep this small, portals will rate limit aggressive clients
+    max_workers: int = 4
+    # Download documents one by one instead of as a single zip
+    prefer_per_doc_parallel: bool = False
+    # Keep request and document info on disk to revalidate with ETags
+    http_cache: bool = True
 
 
 @dataclasses.dataclass
@@ -52,6 +66,9 @@ def default_config(root_dir: str):
                 download_nice_seconds=2,
                 download_timeout_seconds=1200,
                 download_path=__FOIATOOLS_DOWNLOAD__,
+                max_workers=4,
+                prefer_per_doc_parallel=False,
+                http_cache=True,
             ),
         ],
     )
@@ -79,41 +96,61 @@ def init_project(path: str, overwrite=False) -> Config:
     return conf
 
 
+# Keyed on the modification time so edits to the file are always picked up
+@functools.lru_cache(maxsize=8)
+def _load_toml_cached(path: str, mtime_ns: int) -> dict:
+    with open(path, "rb") as f:
+        return tomllib.load(f)
+
+
 def load_config(path: str) -> Config:
     path = os.path.abspath(path)
     if not os.path.exists(path):
         raise RuntimeError(f"Config not found at {path}")
 
     root_dir = os.path.dirname(path)
-    with open(path, "r") as f:
-        config = toml.load(f)
+    # Copy so callers can't modify the cached dict
+    config = copy.deepcopy(_load_toml_cached(path, os.stat(path).st_mtime_ns))
 
-        request_configs = [RequestConfig(**v) for v in config["request_config"]]
-        del config["request_config"]
+    request_configs = [RequestConfig(**v) for v in config["request_config"]]
+    del config["request_config"]
 
-        config = Config(request_config=request_configs, **config)
+    config = Config(request_config=request_configs, **config)
 
-        # make paths absolute
-        if not os.path.isabs(config.db_path):
-            config.db_path = os.path.abspath(os.path.join(root_dir, config.db_path))
+    # make paths absolute
+    if not os.path.isabs(config.db_path):
+        config.db_path = os.path.abspath(os.path.join(root_dir, config.db_path))
 
-        for rc in config.request_config:
-            if not os.path.isabs(rc.download_path):
-                rc.download_path = os.path.abspath(
-                    os.path.join(root_dir, rc.download_path)
-                )
+    for rc in config.request_config:
+        rc.ignore_ids = frozenset(map(str, rc.ignore_ids))
+        if not os.path.isabs(rc.download_path):
+            rc.download_path = os.path.abspath(
+                os.path.join(root_dir, rc.download_path)
+            )
 
-        return config
+    return config
 
 
 def find_project_dir(start_dir=None):
     if not start_dir:
         start_dir = os.getcwd()
+    return _find_project_dir(os.path.abspath(start_dir))
+
+
+# Only found directories are remembered, so a project initialized later in
+# the same process is still picked up
+_PROJECT_DIRS = {}
+
+
+def _find_project_dir(start_dir: str):
+    if found := _PROJECT_DIRS.get(start_dir):
+        return found
 
-    current = pathlib.Path(os.path.abspath(start_dir))
+    current = pathlib.Path(start_dir)
 
     while current.parent != current:
         if (current / __FOIATOOLS_CONFIG__).exists():
+            _PROJECT_DIRS[start_dir] = current
             return current
         current = current.parent
 
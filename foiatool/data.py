@@ -1,7 +1,7 @@
 import peewee as pw
 import enum
 import datetime
-from typing import List, Tuple, Union, Optional
+from typing import List, Set, Tuple, Union, Optional
 import dataclasses
 import hashlib
 
@@ -13,6 +13,12 @@ class RequestStatus(enum.Enum):
     ERROR = 4
 
 
+# Plain ints for the hot query paths, saves an enum lookup per call
+_PENDING = RequestStatus.PENDING.value
+_CLOSED = RequestStatus.CLOSED.value
+_ERROR = RequestStatus.ERROR.value
+
+
 def status_from_str(status: str):
     lut = dict(closed=RequestStatus.CLOSED, open=RequestStatus.PENDING)
     return lut[status.lower()]
@@ -42,6 +48,12 @@ class DatabaseStats:
 # to easily keep track of stats, history, etc on top of the queue.
 db = pw.SqliteDatabase("")
 
+# Rows per statement for batched inserts. Keeps rows * columns under the
+# 999 bound parameter limit of older SQLite builds
+INSERT_BATCH_SIZE = 100
+# That bound parameter limit, for queries that take a list of values
+MAX_SQL_PARAMS = 999
+
 
 class FOIARequest(pw.Model):
     id = pw.PrimaryKeyField()
@@ -56,6 +68,7 @@ class FOIARequest(pw.Model):
     class Meta:
         database = db
         constraints = [pw.SQL("UNIQUE (scrape_source, request_id)")]
+        indexes = ((("request_status",), False),)
 
 
 class DocumentDownload(pw.Model):
@@ -65,11 +78,13 @@ class DocumentDownload(pw.Model):
     date_downloaded = pw.DateField()
     is_bulk = pw.BooleanField()
     download_path = pw.CharField()
+    # blake2b-256 hex digest, rows from older versions hold an MD5
     checksum = pw.CharField()
     document_count = pw.IntegerField()
 
     class Meta:
         database = db
+        indexes = ((("date_downloaded",), False),)
 
 
 class WorkQueue(pw.Model):
@@ -82,6 +97,9 @@ class WorkQueue(pw.Model):
 
     class Meta:
         database = db
+        indexes = (
+            (("target_source", "task_type", "task_target_id", "document_id"), False),
+        )
 
 
 class ScrapeMetadata(pw.Model):
@@ -94,15 +112,63 @@ class ScrapeMetadata(pw.Model):
         constraints = [pw.SQL("UNIQUE (scrape_source)")]
 
 
+def _hash_file(file_path: str, digest):
+    # Hash in 1 MiB blocks so large zips don't have to fit in memory. Reading
+    # into one reused buffer (as hashlib.file_digest does, with a smaller
+    # buffer) avoids allocating a new bytes object per block
+    buf = bytearray(1 << 20)
+    view = memoryview(buf)
+    with open(file_path, "rb", buffering=0) as f:
+        while size := f.readinto(buf):
+            digest.update(view[:size])
+    return digest.hexdigest()
+
+
+# The checksum only identifies files we've downloaded, so use the
+# fastest hash hashlib has rather than MD5. 32 bytes keeps the hex digest
+# distinguishable from the MD5s stored by older versions.
+# Copying an empty hash is cheaper than setting up a new one per file
+_CHECKSUM_PROTO = hashlib.blake2b(digest_size=32)
+_MD5_PROTO = hashlib.md5()
+
+
+def new_checksum():
+    # For hashing a file while it's being written
+    return _CHECKSUM_PROTO.copy()
+
+
+def get_doc_checksum(file_path: str):
+    return _hash_file(file_path, _CHECKSUM_PROTO.copy())
+
+
 def get_doc_md5(file_path: str):
-    with open(file_path, "rb") as f:
-        return hashlib.md5(f.read()).hexdigest()
+    return _hash_file(file_path, _MD5_PROTO.copy())
+
+
+def is_legacy_checksum(checksum: str):
+    return len(checksum) == 32
+
+
+# WAL lets the readers keep going while a download is being recorded, and
+# with it synchronous=NORMAL is still safe against corruption
+SQLITE_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": 1,  # NORMAL
+    "cache_size": -64000,  # 64MB
+    "mmap_size": 268435456,  # 256MB
+    "temp_store": 2,  # MEMORY
+    "foreign_keys": 1,
+    # Wait on a competing writer (e.g. a second foiatool run) instead of
+    # failing straight away with "database is locked"
+    "busy_timeout": 5000,
+}
 
 
 class DBSession:
     def __init__(self, db_path: str) -> None:
-        db.init(db_path)
+        db.init(db_path, pragmas=SQLITE_PRAGMAS)
         db.connect()
+        # Also adds any missing indexes to databases made by older versions
         db.create_tables([FOIARequest, DocumentDownload, WorkQueue, ScrapeMetadata])
 
     def atomic(self):
@@ -117,6 +183,12 @@ class DBSession:
             & (FOIARequest.request_id == request_id)
         )
 
+    def get_request_ids(self, scrape_source: str) -> Set[str]:
+        query = FOIARequest.select(FOIARequest.request_id).where(
+            FOIARequest.scrape_source == scrape_source
+        )
+        return {request_id for (request_id,) in query.tuples()}
+
     def update_request(self, req: FOIARequest, **kwargs):
         where = FOIARequest.id == req.id
         FOIARequest.update(**kwargs).where(where).execute()
@@ -129,22 +201,30 @@ class DBSession:
         request_date: datetime.datetime,
         department: str,
         document_count: int,
+        now: datetime.datetime = None,
     ):
+        now = now or datetime.datetime.now()
         if req := self.get_request(scrape_source, request_id):
             self.update_request(
                 req,
                 department=department,
                 document_count=document_count,
-                date_checked=datetime.datetime.now(),
+                date_checked=now,
                 request_status=request_status.value,
             )
-            return self.get_request(scrape_source, request_id)
+            # Mirror the update on the row we already have instead of
+            # selecting it again
+            req.department = department
+            req.document_count = document_count
+            req.date_checked = now
+            req.request_status = request_status.value
+            return req
         else:
             req = FOIARequest.create(
                 scrape_source=scrape_source,
                 request_id=request_id,
                 date_submitted=request_date,
-                date_checked=datetime.datetime.now(),
+                date_checked=now,
                 department=department,
                 document_count=document_count,
                 request_status=request_status.value,
@@ -165,8 +245,27 @@ class DBSession:
             & (WorkQueue.document_id == document_id)
         )
 
+    def _task_exists(
+        self,
+        task_type: TaskType,
+        target_source: str,
+        target_id: str,
+        document_id: str = None,
+    ) -> bool:
+        # SELECT EXISTS stops at the first hit and doesn't build any rows
+        return (
+            WorkQueue.select(WorkQueue.id)
+            .where(
+                (WorkQueue.target_source == target_source)
+                & (WorkQueue.task_type == task_type.value)
+                & (WorkQueue.task_target_id == target_id)
+                & (WorkQueue.document_id == document_id)
+            )
+            .exists()
+        )
+
     def add_bulk_download_task(self, target_source: str, request_id: str):
-        if self.get_task(TaskType.BULK_DOWNLOAD, target_source, request_id):
+        if self._task_exists(TaskType.BULK_DOWNLOAD, target_source, request_id):
             return
 
         WorkQueue.create(
@@ -175,10 +274,36 @@ class DBSession:
             task_target_id=request_id,
         )
 
+    def add_bulk_download_tasks(self, target_source: str, request_ids: List[str]):
+        # Batched add_bulk_download_task: one lookup and one insert per chunk.
+        # Ids come back from the CharField as strings, so compare them as such
+        request_ids = list(dict.fromkeys(map(str, request_ids)))
+        with db.atomic():
+            for batch in pw.chunked(request_ids, INSERT_BATCH_SIZE):
+                existing = {
+                    t.task_target_id
+                    for t in WorkQueue.select(WorkQueue.task_target_id).where(
+                        (WorkQueue.target_source == target_source)
+                        & (WorkQueue.task_type == TaskType.BULK_DOWNLOAD.value)
+                        & (WorkQueue.task_target_id.in_(batch))
+                    )
+                }
+                rows = [
+                    dict(
+                        target_source=target_source,
+                        task_type=TaskType.BULK_DOWNLOAD.value,
+                        task_target_id=request_id,
+                    )
+                    for request_id in batch
+                    if request_id not in existing
+                ]
+                if rows:
+                    WorkQueue.insert_many(rows).execute()
+
     def add_download_task(
         self, target_source: str, request_id: str, doc_id: str, doc_name: str
     ):
-        if self.get_task(TaskType.DOWNLOAD, target_source, request_id, doc_id):
+        if self._task_exists(TaskType.DOWNLOAD, target_source, request_id, doc_id):
             return
 
         WorkQueue.create(
@@ -189,8 +314,40 @@ class DBSession:
             document_name=doc_name,
         )
 
+    def add_download_tasks(
+        self, target_source: str, tasks: List[Tuple[str, str, str]]
+    ):
+        # Batched add_download_task, tasks are (request_id, doc_id, doc_name).
+        # The portal sends numeric ids but the queue stores strings
+        tasks = [(str(rid), str(did), name) for rid, did, name in tasks]
+        tasks = list({(t[0], t[1]): t for t in tasks}.values())
+        with db.atomic():
+            for batch in pw.chunked(tasks, INSERT_BATCH_SIZE):
+                existing = set(
+                    WorkQueue.select(WorkQueue.task_target_id, WorkQueue.document_id)
+                    .where(
+                        (WorkQueue.target_source == target_source)
+                        & (WorkQueue.task_type == TaskType.DOWNLOAD.value)
+                        & (WorkQueue.document_id.in_([t[1] for t in batch]))
+                    )
+                    .tuples()
+                )
+                rows = [
+                    dict(
+                        target_source=target_source,
+                        task_type=TaskType.DOWNLOAD.value,
+                        task_target_id=request_id,
+                        document_id=doc_id,
+                        document_name=doc_name,
+                    )
+                    for request_id, doc_id, doc_name in batch
+                    if (request_id, doc_id) not in existing
+                ]
+                if rows:
+                    WorkQueue.insert_many(rows).execute()
+
     def add_update_task(self, target_source: str, request_id: str):
-        if self.get_task(TaskType.UPDATE_METADATA, target_source, request_id):
+        if self._task_exists(TaskType.UPDATE_METADATA, target_source, request_id):
             return
 
         WorkQueue.create(
@@ -202,8 +359,22 @@ class DBSession:
     def get_tasks(self, query=None):
         return WorkQueue.select().where(query)
 
-    def get_tasks_for_source(self, target_source: str):
-        return self.get_tasks(WorkQueue.target_source == target_source)
+    def count_tasks(self, query=None) -> int:
+        return WorkQueue.select().where(query).count()
+
+    def get_tasks_for_source(
+        self, target_source: str, exclude_ids: Set[str] = frozenset()
+    ) -> List[WorkQueue]:
+        query = WorkQueue.target_source == target_source
+        # Too many ids to bind (target_source takes one), filter in Python
+        if len(exclude_ids) >= MAX_SQL_PARAMS:
+            return [
+                task for task in self.get_tasks(query)
+                if task.task_target_id not in exclude_ids
+            ]
+        if exclude_ids:
+            query = query & WorkQueue.task_target_id.not_in(list(exclude_ids))
+        return list(self.get_tasks(query))
 
     def clear_tasks(self):
         WorkQueue.delete().execute()
@@ -218,11 +389,22 @@ class DBSession:
         is_bulk: bool,
         document_count: int,
         document_id: str = None,
+        now: datetime.datetime = None,
+        checksum: str = None,
     ) -> DocumentDownload:
-        checksum = get_doc_md5(path)
+        checksum = checksum or get_doc_checksum(path)
+        # A fresh download replaces the record of the previous one, so
+        # redownloads don't leave stale rows behind
+        if is_bulk:
+            same = DocumentDownload.is_bulk == True
+        else:
+            same = DocumentDownload.document_id == document_id
+        DocumentDownload.delete().where(
+            (DocumentDownload.request == request) & same
+        ).execute()
         return DocumentDownload.create(
             request=request,
-            date_downloaded=datetime.datetime.now(),
+            date_downloaded=now or datetime.datetime.now(),
             is_bulk=is_bulk,
             download_path=path,
             checksum=checksum,
@@ -231,12 +413,27 @@ class DBSession:
         )
 
     def add_download(
-        self, request: FOIARequest, path: str, document_id: str
+        self,
+        request: FOIARequest,
+        path: str,
+        document_id: str,
+        now: datetime.datetime = None,
+        checksum: str = None,
     ) -> DocumentDownload:
-        return self._add_download(request, path, False, 1, document_id)
+        return self._add_download(
+            request, path, False, 1, document_id, now, checksum
+        )
 
-    def add_bulk_download(self, request: FOIARequest, path: str) -> DocumentDownload:
-        return self._add_download(request, path, True, request.document_count)
+    def add_bulk_download(
+        self,
+        request: FOIARequest,
+        path: str,
+        now: datetime.datetime = None,
+        checksum: str = None,
+    ) -> DocumentDownload:
+        return self._add_download(
+            request, path, True, request.document_count, now=now, checksum=checksum
+        )
 
     def get_downloads(self, query=None) -> DocumentDownload:
         return DocumentDownload.select().where(query)
@@ -253,6 +450,47 @@ class DBSession:
             .get_or_none()
         )
 
+    def get_downloads_for_source(
+        self, scrape_source: str, before_date: datetime.datetime = None
+    ):
+        # Just the columns repair_data and redownload_requests need
+        query = FOIARequest.scrape_source == scrape_source
+        if before_date:
+            query = query & (DocumentDownload.date_downloaded < before_date)
+        return (
+            DocumentDownload.select(
+                DocumentDownload.id,
+                DocumentDownload.document_id,
+                DocumentDownload.is_bulk,
+                DocumentDownload.download_path,
+                DocumentDownload.checksum,
+                FOIARequest.id,
+                FOIARequest.request_id,
+            )
+            .join(FOIARequest)
+            .where(query)
+        )
+
+    def update_download_path(self, download: DocumentDownload, path: str):
+        DocumentDownload.update(download_path=path).where(
+            DocumentDownload.id == download.id
+        ).execute()
+
+    def remove_download(self, download: DocumentDownload):
+        DocumentDownload.delete().where(DocumentDownload.id == download.id).execute()
+
+    def get_downloaded_document_ids(self, scrape_source: str) -> Set[Tuple[str, str]]:
+        # (request_id, document_id) of every individually downloaded document
+        query = (
+            DocumentDownload.select(FOIARequest.request_id, DocumentDownload.document_id)
+            .join(FOIARequest)
+            .where(
+                (FOIARequest.scrape_source == scrape_source)
+                & (DocumentDownload.document_id.is_null(False))
+            )
+        )
+        return set(query.tuples())
+
     def get_bulk_download(
         self, scrape_source: str, request_id: str, checksum: str = None
     ):
@@ -266,26 +504,39 @@ class DBSession:
 
         return DocumentDownload.select().join(FOIARequest).where(query).get_or_none()
 
-    def mark_request_closed(self, request: FOIARequest):
-        self.update_request(
-            request,
-            date_checked=datetime.datetime.now(),
-            request_status=RequestStatus.CLOSED.value,
-        )
+    def set_status(
+        self,
+        request_ids: List[int],
+        status: RequestStatus,
+        now: datetime.datetime = None,
+    ):
+        # One UPDATE per batch rather than one per request
+        now = now or datetime.datetime.now()
+        with db.atomic():
+            for batch in pw.chunked(request_ids, INSERT_BATCH_SIZE):
+                FOIARequest.update(
+                    date_checked=now, request_status=status.value
+                ).where(FOIARequest.id.in_(batch)).execute()
+
+    def mark_request_closed(
+        self, request: FOIARequest, now: datetime.datetime = None
+    ):
+        self.set_status([request.id], RequestStatus.CLOSED, now)
 
-    def mark_request_error(self, request: FOIARequest):
-        self.update_request(
-            request,
-            date_checked=datetime.datetime.now(),
-            request_status=RequestStatus.ERROR.value,
-        )
+    def mark_request_error(
+        self, request: FOIARequest, now: datetime.datetime = None
+    ):
+        self.set_status([request.id], RequestStatus.ERROR, now)
 
-    def mark_request_pending(self, request: FOIARequest):
-        self.update_request(
-            request,
-            date_checked=datetime.datetime.now(),
-            request_status=RequestStatus.PENDING.value,
-        )
+    def mark_request_pending(
+        self, request: FOIARequest, now: datetime.datetime = None
+    ):
+        self.set_status([request.id], RequestStatus.PENDING, now)
+
+    def mark_requests_pending(
+        self, request_ids: List[int], now: datetime.datetime = None
+    ):
+        self.set_status(request_ids, RequestStatus.PENDING, now)
 
     def get_last_scrape_date(self, source: str) -> Optional[datetime.datetime]:
         try:
@@ -296,21 +547,20 @@ class DBSession:
             return None
 
     def update_scrape_date(self, source: str):
+        now = datetime.datetime.now()
         (
-            ScrapeMetadata.insert(
-                scrape_source=source, last_scrape_date=datetime.datetime.now()
-            )
+            ScrapeMetadata.insert(scrape_source=source, last_scrape_date=now)
             .on_conflict(
                 conflict_target=(ScrapeMetadata.scrape_source,),
                 preserve=(ScrapeMetadata.id, ScrapeMetadata.scrape_source),
-                update={ScrapeMetadata.last_scrape_date: datetime.datetime.now()},
+                update={ScrapeMetadata.last_scrape_date: now},
             )
             .execute()
         )
 
     def get_open_requests(self):
         return FOIARequest.select().where(
-            FOIARequest.request_status == RequestStatus.PENDING.value
+            FOIARequest.request_status == _PENDING
         )
 
     def get_downloaded_requests(self, before_date: datetime.datetime = None):
@@ -321,29 +571,37 @@ class DBSession:
 
     def get_closed_requests(self):
         return FOIARequest.select().where(
-            FOIARequest.request_status == RequestStatus.CLOSED.value
+            FOIARequest.request_status == _CLOSED
         )
 
     def get_error_requests(self):
         return FOIARequest.select().where(
-            FOIARequest.request_status == RequestStatus.ERROR.value
+            FOIARequest.request_status == _ERROR
         )
 
     def get_stats(self) -> DatabaseStats:
-        all_requests = list(self.get_requests())
-        pending = list(self.get_open_requests())
-        downloaded = list(self.get_downloaded_requests())
-        closed = list(self.get_closed_requests())
-        error = list(self.get_error_requests())
-        total_docs = sum([d.document_count for d in downloaded])
-        last_scrape = ScrapeMetadata.get().last_scrape_date
+        # Let SQLite do the counting rather than pulling every row into Python
+        status_counts = dict(
+            FOIARequest.select(
+                FOIARequest.request_status, pw.fn.COUNT(FOIARequest.id)
+            )
+            .group_by(FOIARequest.request_status)
+            .tuples()
+        )
+        download_count, total_docs = DocumentDownload.select(
+            pw.fn.COUNT(DocumentDownload.id),
+            pw.fn.COALESCE(pw.fn.SUM(DocumentDownload.document_count), 0),
+        ).scalar(as_tuple=True)
+        last_scrape = ScrapeMetadata.select(
+            pw.fn.MAX(ScrapeMetadata.last_scrape_date)
+        ).scalar()
 
         return DatabaseStats(
-            total_request_count=len(all_requests),
-            pending_request_count=len(pending),
-            downloaded_request_count=len(downloaded),
-            closed_request_count=len(closed),
-            error_request_count=len(error),
+            total_request_count=sum(status_counts.values()),
+            pending_request_count=status_counts.get(_PENDING, 0),
+            downloaded_request_count=download_count,
+            closed_request_count=status_counts.get(_CLOSED, 0),
+            error_request_count=status_counts.get(_ERROR, 0),
             last_scrape=last_scrape,
             document_count=total_docs,
         )
@@ -7,14 +7,26 @@ import tqdm
 from typing import List, Optional, Union
 import dateutil.parser as dparser
 import logging
-import time
 import os
 import urllib.parse
-import concurrent
+import concurrent.futures
 import datetime
+import functools
+
+# Queued tasks are buffered across search pages and written this many at a time
+TASK_FLUSH_SIZE = 500
 
 def parse_datetime(txt: str, permissive:bool = False):
-    return dparser.parse(txt, fuzzy=permissive)
+    # The portal normally sends ISO dates, which fromisoformat handles far
+    # faster than dateutil. Anything else still goes through dateutil
+    try:
+        return datetime.datetime.fromisoformat(txt)
+    except ValueError:
+        return dparser.parse(txt, fuzzy=permissive)
+
+@functools.lru_cache(maxsize=1024)
+def _parse_url (url: str):
+    return urllib.parse.urlparse(url)
 
 def get_user_choice (prompt, default = False):
     yeses = ["y", "yes", "1"]
@@ -34,113 +46,179 @@ def fetch_new_requests (
 ):
     with dbsess.atomic():
         last_update = dbsess.get_last_scrape_date(config.url)
-        initial_count = len(dbsess.get_tasks())
+        initial_count = dbsess.count_tasks()
         logging.info(f"Fetching latest request updates for search terms {config.search_terms}")
         logging.info(f"Fetching latest documents for search terms {config.document_search_terms}")
         logging.info(f"Index last updated on {last_update}")
 
         # Search foia requests
-        pbar = tqdm.tqdm()
+        # Known requests are loaded up front so each page costs one batched
+        # insert instead of a lookup and insert per item
+        source = driver.url()
+        known_requests = dbsess.get_request_ids(config.url)
+        known_requests.update(config.ignore_ids)
+        new_requests = []
+        pbar = tqdm.tqdm(mininterval=0.5, smoothing=0)
         pbar.set_description("Searching Requests")
         for term in config.search_terms:
             for page in driver.search_requests(term, fapi.NextRequestAPI.IS_CLOSED):
-                for item in page:
-                    if dbsess.get_request(item["id"], config.url) or item["id"] in config.ignore_ids:
-                        continue
-                    dbsess.add_bulk_download_task(driver.url(), item["id"])
-                    pbar.update(1)
-
-                # Be nice
-                time.sleep(config.download_nice_seconds)
+                # ids are compared as strings, which is how they're stored
+                new_ids = [
+                    request_id for request_id in (str(item["id"]) for item in page)
+                    if request_id not in known_requests
+                ]
+                new_requests.extend(new_ids)
+                if len(new_requests) >= TASK_FLUSH_SIZE:
+                    dbsess.add_bulk_download_tasks(source, new_requests)
+                    new_requests.clear()
+                pbar.update(len(new_ids))
+            dbsess.add_bulk_download_tasks(source, new_requests)
+            new_requests.clear()
         pbar.close()
 
         # Search through documents
-        pbar = tqdm.tqdm()
+        downloaded_docs = dbsess.get_downloaded_document_ids(source)
+        new_docs = []
+        pbar = tqdm.tqdm(mininterval=0.5, smoothing=0)
         pbar.set_description("Searching Documents")
         for term in config.document_search_terms:
             for page in driver.search_documents(term):
+                page_count = 0
                 for item in page:
                     # some documents aren't associated with a request...
                     request_id = item.get("pretty_id", None)
-                    doc_id = item["id"]
+                    doc_id = str(item["id"])
                     title = item["title"]
                     fname = f"{doc_id}_{title}"
 
-                    if not request_id or dbsess.get_download(driver.url(), request_id, doc_id):
+                    if not request_id or (request_id, doc_id) in downloaded_docs:
                         continue
 
-                    dbsess.add_download_task(driver.url(), request_id, doc_id, fname)
-                    pbar.update(1)
+                    new_docs.append((request_id, doc_id, fname))
+                    page_count += 1
 
-                # Be nice
-                time.sleep(config.download_nice_seconds)
+                if len(new_docs) >= TASK_FLUSH_SIZE:
+                    dbsess.add_download_tasks(source, new_docs)
+                    new_docs.clear()
+                pbar.update(page_count)
+            dbsess.add_download_tasks(source, new_docs)
+            new_docs.clear()
         pbar.close()
 
         dbsess.update_scrape_date(config.url)
 
-        new_count = len(dbsess.get_tasks())
+        new_count = dbsess.count_tasks()
         logging.info(f"Fetching complete. Found {new_count - initial_count} new documents")
 
 
+def _process_task (
+    config: fconfig.RequestConfig,
+    driver: fapi.NextRequestAPI,
+    req: fdb.WorkQueue
+):
+    # Runs on a worker thread so it must not touch the database.
+    # Returns everything needed to record the task afterwards
+    try:
+        req_info = driver.get_request_info(req.task_target_id)
+        req_status = fdb.status_from_str(req_info["request_state"])
+
+        doc_info = driver.get_docs_info_for_request(req_info["pretty_id"])
+    except (KeyError, TypeError, ValueError, fapi.RequestException):
+        # Couldn't look the request up, there's nothing to record. The task
+        # stays on the queue for the next run
+        return req, None, None, None, [], None, True
+
+    # Downloads resolve to (path, checksum)
+    downloads = []
+    bulk = None
+    failed = False
+    try:
+        if req.task_type == fdb.TaskType.DOWNLOAD.value:
+            promise = driver.download_document(req.task_target_id, req.document_id, req.document_name, config.download_timeout_seconds)
+            downloads.append((req.document_id, *fapi.wait_for_download(promise, config.download_timeout_seconds)))
+        elif req.task_type == fdb.TaskType.BULK_DOWNLOAD.value and req_status == fdb.RequestStatus.CLOSED:
+            # The document list can be a single page, in which case only the
+            # zip is guaranteed to contain everything
+            all_listed = len(doc_info.get("documents", [])) >= doc_info.get("total_documents_count", 0)
+            if config.prefer_per_doc_parallel and all_listed:
+                downloads = driver.download_all_documents_parallel(req.task_target_id, config.download_timeout_seconds, doc_info)
+            else:
+                promise = driver.download_docs_for_request(req.task_target_id, config.download_timeout_seconds)
+                bulk = fapi.wait_for_download(promise, config.download_timeout_seconds)
+    except (concurrent.futures.TimeoutError, concurrent.futures.InvalidStateError, fapi.DownloadException, fapi.RequestException, OSError):
+        # for some reason the document failed to download. Ignore this document for the time being
+        failed = True
+
+    return req, req_info, req_status, doc_info, downloads, bulk, failed
+
+
 def visit_pending_requests (
     config: fconfig.RequestConfig, 
     dbsess: fdb.DBSession,
     driver: fapi.NextRequestAPI
 ):
-    pending = dbsess.get_tasks_for_source(config.url)
+    # Ignored requests are filtered out by SQLite rather than in Python
+    pending = dbsess.get_tasks_for_source(config.url, config.ignore_ids)
 
     logging.info(f"Found {len(pending)} requests in the queue. Visiting")
-    logging.info(f"Ignoring requests: {config.ignore_ids}")
+    logging.info(f"Ignoring requests: {sorted(config.ignore_ids)}")
 
     driver.sign_in()
 
+    # Tasks are independent, so overlap their network time on a small pool.
+    # Only this thread writes to the database
     error_count = 0
-    pbar = tqdm.tqdm(pending)
-    for req in pbar:
-        pbar.set_description(f"Fetching request information {req.task_target_id}")
-        req_info = driver.get_request_info(req.task_target_id)
-        req_status = fdb.status_from_str(req_info["request_state"])
-
-        dept_names = req_info["department_names"]
-        doc_info = driver.get_docs_info_for_request(req_info["pretty_id"])
-        doc_count = doc_info.get("total_documents_count", 0)
-        request_date = parse_datetime(req_info.get("request_date", ""), True)
-
-        foia_request = dbsess.add_request(
-            config.url,
-            req_info["pretty_id"],
-            req_status,
-            request_date,
-            dept_names,
-            doc_count
-        )
-
-        if req.task_type not in [fdb.TaskType.DOWNLOAD.value, fdb.TaskType.BULK_DOWNLOAD.value]:
-            dbsess.mark_task_completed(req)
-            continue
-
+    pbar = tqdm.tqdm(total=len(pending))
+    pbar.set_description("Visiting requests")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=config.max_workers or 4) as pool:
+        futures = [pool.submit(_process_task, config, driver, req) for req in pending]
         try:
-            pbar.set_description(f"Waiting for documents to download for {req.task_target_id}")
-            if req.task_type == fdb.TaskType.DOWNLOAD.value:
-                promise = driver.download_document(req.task_target_id, req.document_id, req.document_name)
-                result_path = promise.result(config.download_timeout_seconds)
-                dbsess.add_download(foia_request, result_path, req.document_id)
-                dbsess.mark_task_completed(req)
-            else:
-                if req_status != fdb.RequestStatus.CLOSED:
-                    # Keep the task on the queue
+            for future in concurrent.futures.as_completed(futures):
+                req, req_info, req_status, doc_info, downloads, bulk, failed = future.result()
+                pbar.update(1)
+                if failed:
+                    error_count += 1
+                    pbar.set_postfix({"errors": error_count})
+                if req_info is None:
                     continue
-                promise = driver.download_docs_for_request(req.task_target_id)
-                result_path = promise.result(config.download_timeout_seconds)
-                dbsess.add_bulk_download(foia_request, result_path)
-        except (TimeoutError, concurrent.futures.InvalidStateError, fapi.DownloadException, fapi.HTTPException, fapi.ConnectionException):
-            # for some reason the document failed to download. Ignore this document for the time being
-            dbsess.mark_request_error(foia_request)
-            error_count += 1
-            pbar.set_postfix({"errors": error_count})
-
-        # Be nice
-        time.sleep(config.download_nice_seconds)
+
+                dept_names = req_info["department_names"]
+                doc_count = doc_info.get("total_documents_count", 0)
+                request_date = parse_datetime(req_info.get("request_date", ""), True)
+
+                # Record everything about this task in a single transaction so
+                # each task costs one commit, all stamped with the same time
+                now = datetime.datetime.now()
+                with dbsess.atomic():
+                    foia_request = dbsess.add_request(
+                        config.url,
+                        req_info["pretty_id"],
+                        req_status,
+                        request_date,
+                        dept_names,
+                        doc_count,
+                        now
+                    )
+
+                    if failed:
+                        dbsess.mark_request_error(foia_request, now)
+                    elif req.task_type == fdb.TaskType.BULK_DOWNLOAD.value and req_status != fdb.RequestStatus.CLOSED:
+                        # Keep the task on the queue
+                        pass
+                    else:
+                        for doc_id, result_path, checksum in downloads:
+                            dbsess.add_download(foia_request, result_path, doc_id, now, checksum)
+                        if bulk:
+                            bulk_path, checksum = bulk
+                            dbsess.add_bulk_download(foia_request, bulk_path, now, checksum)
+                        dbsess.mark_task_completed(req)
+        except BaseException:
+            # Leaving the block waits on the pool, don't let it work through
+            # the rest of the queue for results nobody will record
+            for future in futures:
+                future.cancel()
+            raise
+    pbar.close()
 
 def redownload_requests (
     config: fconfig.RequestConfig,
@@ -150,14 +228,36 @@ def redownload_requests (
 ):
     logging.info(f"Redownloading documents")
 
-    reqs = dbsess.get_downloaded_requests(before_date)
-    for req in reqs:
-        # Put the requests back on the work queue
-        dbsess.mark_document_pending(req)
+    downloads = list(dbsess.get_downloads_for_source(config.url, before_date).iterator())
+    bulk_tasks = [dl.request.request_id for dl in downloads if dl.is_bulk]
+    doc_tasks = [
+        (dl.request.request_id, dl.document_id, os.path.basename(dl.download_path))
+        for dl in downloads if not dl.is_bulk
+    ]
+
+    # Put the requests back on the work queue in one transaction. The old
+    # download records are kept until a new download replaces them, so a
+    # failed redownload doesn't lose track of the file on disk
+    with dbsess.atomic():
+        dbsess.add_bulk_download_tasks(nrapi.url(), bulk_tasks)
+        dbsess.add_download_tasks(nrapi.url(), doc_tasks)
+        dbsess.mark_requests_pending(list({dl.request.id for dl in downloads}))
 
     visit_pending_requests(config, dbsess, nrapi)
 
 
+def _iter_files (root: str, rel_dir: str = ""):
+    # Yields paths relative to root. scandir's entries already know their
+    # type, so unlike os.walk this doesn't need a stat per file
+    with os.scandir(os.path.join(root, rel_dir)) as it:
+        for entry in it:
+            rel_path = os.path.join(rel_dir, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                yield from _iter_files(root, rel_path)
+            elif entry.is_file(follow_symlinks=False):
+                yield rel_path
+
+
 # Finds records whose downloaded document has been moved or deleted.
 # This can fix the database if the whole project folder has been moved.
 # TODO: I shouldn't store the entire download path, but instead the 
@@ -167,35 +267,60 @@ def repair_data (
     dbsess: fdb.DBSession,
     nrapi: fapi.NextRequestAPI
 ):
-    logging.info("Creating downloaded document index")
-
-    index = {}
-    for dpath, _, files in os.walk(nrapi.download_dir()):
-        for file in files:
-            fpath = os.path.join(dpath, file)
-            chksum = fdb.get_doc_md5(fpath)
-            index[chksum] = fpath
-
     logging.info("Repairing data and ensuring integrity")
 
-    pbar = tqdm.tqdm(dbsess.get_requests())
-    bad_count = 0
+    # One walk of the download folder instead of a stat per record. Paths
+    # are kept relative to it, which keeps them and the index small
+    root = nrapi.download_dir()
+    paths = list(_iter_files(root))
+    existing = set(paths)
 
-    for req in pbar:
-        pbar.set_description(f"Checking request: {req.request_id}")
+    # Stream the rows so only the broken ones stay in memory
+    missing = [
+        dl for dl in dbsess.get_downloads_for_source(config.url).iterator()
+        if os.path.relpath(dl.download_path, root) not in existing
+    ]
 
-        if req.request_id in config.ignore_ids:
-            dbsess.mark_document_error(req)
+    # Only hash the folder when something actually went missing
+    index = {}
+    if missing:
+        logging.info("Creating downloaded document index")
+        hashers = [fdb.get_doc_checksum]
+        if any(fdb.is_legacy_checksum(dl.checksum) for dl in missing):
+            hashers.append(fdb.get_doc_md5)
+        # hashlib drops the GIL while reading and hashing, so threads hash
+        # files in parallel. Extra threads cover time spent waiting on the disk
+        workers = min(32, (os.cpu_count() or 1) * 4)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            for hasher in hashers:
+                abs_paths = (os.path.join(root, p) for p in paths)
+                index.update(zip(pool.map(hasher, abs_paths), paths))
+
+    # Every fix goes into one transaction rather than a commit per record
+    bad_count = 0
+    with dbsess.atomic():
+        for request_id in config.ignore_ids:
+            if req := dbsess.get_request(config.url, request_id):
+                dbsess.mark_request_error(req)
+                bad_count += 1
+
+        pbar = tqdm.tqdm(missing)
+        for dl in pbar:
+            pbar.set_description(f"Checking request: {dl.request.request_id}")
+
+            if rel_path := index.get(dl.checksum, ""):
+                dbsess.update_download_path(dl, os.path.join(root, rel_path))
+                continue
+
+            # The file is gone, put it back on the work queue
+            dbsess.remove_download(dl)
+            if dl.is_bulk:
+                dbsess.add_bulk_download_task(nrapi.url(), dl.request.request_id)
+            else:
+                fname = os.path.basename(dl.download_path)
+                dbsess.add_download_task(nrapi.url(), dl.request.request_id, dl.document_id, fname)
             bad_count += 1
 
-        elif req.request_status == fdb.RequestStatus.DOWNLOADED.value:
-            if (not os.path.exists(req.document_paths)):
-                if npath := index.get(req.download_checksum, ""):
-                    dbsess.mark_document_downloaded(req, npath, req.document_count, req.download_checksum)
-                else:
-                    dbsess.mark_document_pending(req)
-                    bad_count += 1
-    
     logging.info(f"Found {bad_count} broken records")
     visit_pending_requests(config, dbsess, nrapi)
 
@@ -276,7 +401,8 @@ def main ():
         return
     elif args.cmd == "stats":
         stats = dbsess.get_stats()
-        total = stats.total_request_count
+        # Avoid dividing by zero on a fresh database
+        total = stats.total_request_count or 1
         msg = f"""total_requests: {stats.total_request_count}
 error_requests: {stats.error_request_count} ({stats.error_request_count / total})
 pending_requests: {stats.pending_request_count} ({stats.pending_request_count / total})
@@ -289,9 +415,10 @@ document_count: {stats.document_count}"""
     # Initialize API clients
     apis_lut = {}
     for rc in config.request_config:
-        url_parts = urllib.parse.urlparse(rc.url)
+        url_parts = _parse_url(rc.url)
         api = fapi.initialize_nextrequest_client(rc)
-        apis_lut[url_parts.netloc] = (api, rc)
+        # Host names are case insensitive
+        apis_lut[url_parts.netloc.lower()] = (api, rc)
 
 
     if args.cmd == "redownload":
@@ -304,8 +431,8 @@ document_count: {stats.document_count}"""
         for nrapi, conf in apis_lut.values():
             repair_data(conf, dbsess, nrapi)
     elif args.cmd == "fetch":
-        url_parts = urllib.parse.urlparse(args.request_url)
-        if res := apis_lut.get(url_parts.netloc):
+        url_parts = _parse_url(args.request_url)
+        if res := apis_lut.get(url_parts.netloc.lower()):
             nrapi, conf = res
             req_id = url_parts.path.strip("/").split("/")[-1]
             fetch_request_documents(conf, dbsess, nrapi, req_id)
@@ -318,6 +445,9 @@ document_count: {stats.document_count}"""
                 fetch_new_requests(conf, dbsess, nrapi)
             visit_pending_requests(conf, dbsess, nrapi)
 
+    for nrapi, _ in apis_lut.values():
+        nrapi.close()
+
 
 if __name__ == "__main__":
     main()